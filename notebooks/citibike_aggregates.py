@@ -0,0 +1,310 @@
+# citibike_aggregates.py
+# Small per-day / per-station / per-route tables derived from the 2022 trips.
+# scripts/build_aggregates.py writes them to temp_storage/data_prepared/ once,
+# and the dashboards load those files instead of grouping the raw trips.
+import os
+from contextlib import nullcontext
+from urllib.request import urlopen
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = None
+
+try:
+    import h3
+except ImportError:
+    h3 = None
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RAW_PARQUET_PATH = os.path.join(project_root, "temp_storage", "data_raw", "citibike_weather_2022.parquet")
+PREPARED_DIR = os.path.join(project_root, "temp_storage", "data_prepared")
+DAILY_PATH = os.path.join(PREPARED_DIR, "daily.feather")  # 365 rows, uncompressed Arrow IPC
+STATIONS_PATH = os.path.join(PREPARED_DIR, "stations.parquet")
+ROUTES_PATH = os.path.join(PREPARED_DIR, "routes.parquet")
+HEXES_PATH = os.path.join(PREPARED_DIR, "hexes.parquet")  # only built when h3 is installed
+RAW_CSV_PATH = os.path.join(project_root, "temp_storage", "data_raw", "citibike_weather_2022.csv")
+CHUNK_SIZE = 500_000
+H3_RESOLUTION = 9
+
+# Station names are expected as 'category' dtype (NumPy-backed, not pyarrow):
+# groupby then hashes integer codes, and observed=True skips unused categories.
+# Do not switch to dtype_backend="pyarrow" - pandas groupby on ArrowDtype
+# columns is many times slower; where Arrow semantics are wanted, group in
+# PyArrow (or Polars) directly, as route_aggregate() does. read_trips_parquet()
+# asserts this for the frames the dashboards aggregate.
+
+# Types of the merged CSV columns, so read_csv does not have to infer them.
+# float32 keeps ~1 m precision for lat/lng and halves the bytes of float64;
+# aggregate counts are stored as int32.
+TRIP_DTYPES = {
+    "start_station_name": "category",
+    "end_station_name": "category",
+    "start_lat": "float32",
+    "start_lng": "float32",
+    "end_lat": "float32",
+    "end_lng": "float32",
+    "avgTemp": "float32"
+}
+DATE_FORMAT = "%Y-%m-%d"
+
+# Raw columns each aggregate is built from
+DAILY_COLUMNS = ["date", "avgTemp"]
+STATION_COLUMNS = ["start_station_name", "start_lat", "start_lng"]
+ROUTE_COLUMNS = ["start_station_name", "end_station_name", "start_lat", "start_lng", "end_lat", "end_lng"]
+ROUTE_KEYS = ["start_station_name", "end_station_name"]  # station -> coordinates is 1:1
+POINT_COLUMNS = ["start_lat", "start_lng"]
+
+# Tables aggregate_csv_in_chunks() can build, and the raw columns each one reads
+AGGREGATE_TABLES = ("daily", "stations", "routes", "points")
+TABLE_COLUMNS = {
+    "daily": DAILY_COLUMNS,
+    "stations": STATION_COLUMNS,
+    "routes": ROUTE_COLUMNS,
+    "points": POINT_COLUMNS
+}
+
+
+def file_mtime(path):
+    """Modification time of a prepared file (None if missing), used as a cheap cache key."""
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def source_mtime(path, *fallbacks):
+    """mtime of the first of path and its fallback sources that exists (None if none does).
+
+    Loaders that fall back to the raw trips are keyed on this, so their cached
+    result is invalidated when whichever file it was built from changes.
+    """
+    for p in (path,) + fallbacks:
+        if os.path.exists(p):
+            return os.path.getmtime(p)
+    return None
+
+
+def _read_trips_csv_arrow(path, columns, skip_bad_lines):
+    """Parse the CSV with PyArrow's multi-threaded reader and hand it to pandas."""
+    column_types = {
+        c: pa.dictionary(pa.int32(), pa.string()) if t == "category" else pa.float32()
+        for c, t in TRIP_DTYPES.items()
+    }
+    column_types["date"] = pa.timestamp("ns")
+
+    options = dict(
+        parse_options=pacsv.ParseOptions(invalid_row_handler=(lambda row: "skip") if skip_bad_lines else None),
+        convert_options=pacsv.ConvertOptions(
+            column_types=column_types,
+            include_columns=columns,
+            timestamp_parsers=[DATE_FORMAT],
+            # Empty station names become nulls, as with pandas' read_csv
+            strings_can_be_null=True
+        )
+    )
+    if path.startswith(("http://", "https://")):
+        with urlopen(path) as response:
+            table = pacsv.read_csv(response, **options)
+    else:
+        table = pacsv.read_csv(path, **options)
+    # NumPy-backed pandas columns (categories stay categories), no pyarrow dtypes
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def read_trips_parquet(columns, path=RAW_PARQUET_PATH):
+    """Read only `columns` of the raw trips Parquet written by scripts/csv_to_parquet.py.
+
+    That file already stores 'date' as a timestamp and the station names
+    dictionary-encoded, which pandas reads back as categories.
+    """
+    df = pd.read_parquet(path, columns=columns, engine="pyarrow")
+    assert not any(isinstance(dtype, pd.ArrowDtype) for dtype in df.dtypes), \
+        "Use category + NumPy dtypes here, not dtype_backend='pyarrow'"
+    return df
+
+
+def read_trips_csv(path, columns=None, **kwargs):
+    """Read the merged trips CSV with typed columns and 'date' parsed in the same pass.
+
+    With chunksize= in kwargs this returns pandas' chunk iterator instead.
+    """
+    if pa is not None and "chunksize" not in kwargs:
+        try:
+            return _read_trips_csv_arrow(path, columns, kwargs.get("on_bad_lines") == "skip")
+        except pa.ArrowInvalid:
+            pass  # Let the pandas parser below deal with whatever Arrow rejected
+
+    wanted = TRIP_DTYPES if columns is None else {c: TRIP_DTYPES[c] for c in columns if c in TRIP_DTYPES}
+    parse_dates = ["date"] if columns is None or "date" in columns else None
+    return pd.read_csv(
+        path,
+        usecols=columns,
+        parse_dates=parse_dates,
+        date_format=DATE_FORMAT,
+        dtype=wanted,
+        **kwargs
+    )
+
+
+# The *_aggregate functions below never modify the trips frame they are given.
+
+def daily_aggregate(df):
+    """Trips per day and the day's average temperature: date, trip_count, avgTemp."""
+    if "avgTemp" not in df.columns:
+        daily_trips = df.groupby("date").size().astype("int32").reset_index(name="trip_count")
+        daily_trips["avgTemp"] = pd.Series(float("nan"), index=daily_trips.index, dtype="float32")
+        return daily_trips
+
+    # One groupby for both columns instead of two groupbys and a merge
+    return (
+        df.groupby("date", sort=True, observed=True)
+        .agg(trip_count=("date", "size"), avgTemp=("avgTemp", "mean"))
+        .astype({"trip_count": "int32", "avgTemp": "float32"})
+        .reset_index()
+    )
+
+
+def station_aggregate(df):
+    """Trips per start station with its coordinates, busiest station first."""
+    return (
+        df.groupby("start_station_name", observed=True)
+        .agg(
+            start_lat=("start_lat", "first"),
+            start_lng=("start_lng", "first"),
+            trip_count=("start_station_name", "size")
+        )
+        .astype({"trip_count": "int32"})
+        .reset_index()
+        # Plain strings on the small result keep plotly's bars in trip-count order
+        .astype({"start_station_name": str})
+        .sort_values("trip_count", ascending=False, ignore_index=True)
+    )
+
+
+def route_aggregate(df):
+    """Trips per start/end station pair, used by the Kepler map.
+
+    Grouped on the two station names only, with the first coordinates seen for
+    each pair; grouping on the float lat/lng as well would split a route on
+    coordinate noise (e.g. GPS positions of e-bikes).
+    """
+    if pa is not None:
+        # Hash aggregate on the two dictionary-encoded keys in Arrow's C++ kernels;
+        # rows with a missing station are dropped first, like pandas' groupby does
+        table = pa.Table.from_pandas(df[ROUTE_COLUMNS], preserve_index=False)
+        table = table.filter(pc.and_(*[pc.is_valid(table[k]) for k in ROUTE_KEYS]))
+        routes = (
+            table.group_by(ROUTE_KEYS, use_threads=False)
+            .aggregate([(c, "first") for c in ROUTE_COLUMNS[2:]] + [([], "count_all")])
+            .to_pandas()
+            .rename(columns={**{f"{c}_first": c for c in ROUTE_COLUMNS[2:]}, "count_all": "trip_count"})
+        )
+        return routes[ROUTE_COLUMNS + ["trip_count"]].astype({"trip_count": "int32"})
+
+    return (
+        df.groupby(ROUTE_KEYS, observed=True)
+        .agg(
+            start_lat=("start_lat", "first"),
+            start_lng=("start_lng", "first"),
+            end_lat=("end_lat", "first"),
+            end_lng=("end_lng", "first"),
+            trip_count=("start_station_name", "size")
+        )
+        .astype({"trip_count": "int32"})
+        .reset_index()
+    )
+
+
+def point_aggregate(df):
+    """Trips per distinct start coordinate, the input of hex_aggregate()."""
+    return (
+        df.groupby(POINT_COLUMNS)
+        .size()
+        .astype("int32")
+        .reset_index(name="trip_count")
+    )
+
+
+def hex_aggregate(points, resolution=H3_RESOLUTION):
+    """Trips per H3 cell of the start coordinates, for Kepler's hexagon layer.
+
+    h3 is only called once per distinct coordinate, not once per trip.
+    Points without coordinates are skipped, h3 rejects NaN lat/lng.
+    """
+    points = points.dropna(subset=POINT_COLUMNS)
+    cells = [h3.latlng_to_cell(lat, lng, resolution) for lat, lng in zip(points["start_lat"], points["start_lng"])]
+    return (
+        points.groupby(cells)["trip_count"]
+        .sum()
+        .astype("int32")
+        .rename_axis("h3")
+        .reset_index()
+        .sort_values("trip_count", ascending=False, ignore_index=True)
+    )
+
+
+def aggregate_csv_in_chunks(path, tables=AGGREGATE_TABLES, chunksize=CHUNK_SIZE, **kwargs):
+    """The requested daily/stations/routes/points tables from the merged CSV, streamed in chunks.
+
+    Returns a tuple in the order of `tables`. Only the columns and per-chunk
+    partial aggregates those tables need are kept, never the full trip table,
+    so peak memory stays bounded by the chunk size. An http(s) path is opened
+    with urlopen and parsed while it downloads instead of being fetched whole.
+    """
+    partials = {t: [] for t in tables}
+    columns = list(dict.fromkeys(c for t in tables for c in TABLE_COLUMNS[t]))
+    source = urlopen(path) if path.startswith(("http://", "https://")) else nullcontext(path)
+    with source as csv_file:
+        for chunk in read_trips_csv(csv_file, columns, chunksize=chunksize, **kwargs):
+            if "daily" in partials:
+                partials["daily"].append(
+                    chunk.groupby("date")
+                    .agg(trip_count=("date", "size"), temp_sum=("avgTemp", "sum"), temp_n=("avgTemp", "count"))
+                )
+            if "stations" in partials:
+                partials["stations"].append(
+                    chunk.groupby("start_station_name", observed=True)
+                    .agg(
+                        start_lat=("start_lat", "first"),
+                        start_lng=("start_lng", "first"),
+                        trip_count=("start_station_name", "size")
+                    )
+                )
+            if "routes" in partials:
+                partials["routes"].append(route_aggregate(chunk))
+            if "points" in partials:
+                partials["points"].append(point_aggregate(chunk))
+
+    # Combine the partial results: counts and temperature sums add up across chunks
+    results = {}
+    if "daily" in partials:
+        daily = pd.concat(partials["daily"]).groupby(level="date").sum()
+        results["daily"] = (
+            daily.assign(avgTemp=daily["temp_sum"] / daily["temp_n"])[["trip_count", "avgTemp"]]
+            .astype({"trip_count": "int32", "avgTemp": "float32"})
+            .reset_index()
+        )
+    if "stations" in partials:
+        results["stations"] = (
+            pd.concat(partials["stations"])
+            .groupby(level="start_station_name", observed=True)
+            .agg({"start_lat": "first", "start_lng": "first", "trip_count": "sum"})
+            .astype({"trip_count": "int32"})
+            .reset_index()
+            .astype({"start_station_name": str})
+            .sort_values("trip_count", ascending=False, ignore_index=True)
+        )
+    if "routes" in partials:
+        results["routes"] = (
+            pd.concat(partials["routes"])
+            .groupby(ROUTE_KEYS, observed=True)
+            .agg({"start_lat": "first", "start_lng": "first", "end_lat": "first", "end_lng": "first", "trip_count": "sum"})
+            .astype({"trip_count": "int32"})
+            .reset_index()
+        )
+    if "points" in partials:
+        results["points"] = (
+            pd.concat(partials["points"]).groupby(POINT_COLUMNS)["trip_count"].sum().astype("int32").reset_index()
+        )
+    return tuple(results[t] for t in tables)
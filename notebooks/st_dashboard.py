@@ -4,7 +4,12 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import os
-from keplergl import KeplerGl
+import json
+from citibike_aggregates import (
+    RAW_PARQUET_PATH, RAW_CSV_PATH, DAILY_PATH, STATIONS_PATH, ROUTES_PATH, HEXES_PATH,
+    DAILY_COLUMNS, STATION_COLUMNS, ROUTE_COLUMNS,
+    file_mtime, source_mtime, read_trips_parquet, aggregate_csv_in_chunks, daily_aggregate, station_aggregate, route_aggregate
+)
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -21,27 +26,107 @@ This dashboard combines trip data and weather records to highlight patterns in r
 """)
 
 # --- LOAD DATA ---
-@st.cache_data
-def load_data():
-    base_path = os.path.dirname(os.path.abspath(__file__))     # path to notebooks/
-    csv_path = os.path.join(base_path, "../temp_storage/data_raw/citibike_weather_2022.csv")
-    csv_path = os.path.normpath(csv_path)
-    df = pd.read_csv(csv_path)
-    df["date"] = pd.to_datetime(df["date"])
-    return df
-
-# ✅ Load dataset
-df = load_data()
+# Raw trips, only read with the columns an aggregate below needs.
+# Not cached: the aggregates built from it are, and keeping each ~30M-row
+# column selection alive would hold several copies of the trips in memory.
+def load_data(columns):
+    return read_trips_parquet(columns)
+
+# --- CSV FALLBACK ---
+# Without the Parquet file, the merged CSV is streamed in chunks and only
+# the daily, station and route aggregates the pages use are kept, never all
+# trips at once.
+@st.cache_data(persist="disk", show_spinner="Aggregating the trips CSV…")
+def load_csv_aggregates(path, mtime):
+    return aggregate_csv_in_chunks(path, ("daily", "stations", "routes"))
+
+# --- LOAD AGGREGATES ---
+# Built by scripts/build_aggregates.py; the raw trips are only grouped here
+# as a fallback when the prepared files are missing.
+# Results are persisted to disk, so a restarted app skips the raw load.
+# The cache key is (path, mtime), never a DataFrame, where mtime is that of
+# the file the result is read from: the prepared file, or else the raw
+# Parquet/CSV it falls back to. Rebuilding any of them gives a new entry.
+@st.cache_data(persist="disk", show_spinner="Loading daily trips…")
+def load_daily(path, mtime):
+    if os.path.exists(path):
+        return pd.read_feather(path)
+    if os.path.exists(RAW_PARQUET_PATH):
+        return daily_aggregate(load_data(DAILY_COLUMNS))
+    return load_csv_aggregates(RAW_CSV_PATH, file_mtime(RAW_CSV_PATH))[0]
+
+@st.cache_data(persist="disk", show_spinner="Loading station totals…")
+def load_stations(path, mtime):
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    if os.path.exists(RAW_PARQUET_PATH):
+        return station_aggregate(load_data(STATION_COLUMNS))
+    return load_csv_aggregates(RAW_CSV_PATH, file_mtime(RAW_CSV_PATH))[1]
+
+@st.cache_data(persist="disk", show_spinner="Loading station routes…")
+def load_routes(path, mtime):
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    if os.path.exists(RAW_PARQUET_PATH):
+        return route_aggregate(load_data(ROUTE_COLUMNS))
+    return load_csv_aggregates(RAW_CSV_PATH, file_mtime(RAW_CSV_PATH))[2]
+
+# --- KEPLER H3 DEMAND LAYER ---
+# Added on top of config.json when scripts/build_aggregates.py wrote hexes.parquet
+H3_LAYER = {
+    "id": "h3_demand",
+    "type": "hexagonId",
+    "config": {
+        "dataId": "CitiBike 2022 demand",
+        "label": "start demand (H3)",
+        "columns": {"hex_id": "h3"},
+        "isVisible": True,
+        "visConfig": {"opacity": 0.7, "coverage": 1, "enable3d": False}
+    },
+    "visualChannels": {
+        "colorField": {"name": "trip_count", "type": "integer"},
+        "colorScale": "quantile"
+    }
+}
+
+# --- KEPLER MAP HTML ---
+def build_kepler_map(map_path, config_path, with_hexes):
+    # keplergl is slow to import and only needed to (re)build the map
+    from keplergl import KeplerGl
+
+    # Load the custom Kepler configuration
+    with open(config_path, "r", encoding="utf-8") as cfg:
+        custom_config = json.load(cfg)["config"]
+
+    data = {"CitiBike 2022": load_routes(ROUTES_PATH, source_mtime(ROUTES_PATH, RAW_PARQUET_PATH, RAW_CSV_PATH))}
+    if with_hexes:
+        data["CitiBike 2022 demand"] = pd.read_parquet(HEXES_PATH)
+        custom_config["visState"]["layers"].append(H3_LAYER)
+
+    map_1 = KeplerGl(height=600, data=data, config=custom_config)
+    map_1.save_to_html(file_name=map_path)
+
+# Read from disk, or built from the route table and saved, at most once per
+# hexes.parquet version: hexes_mtime is part of the cache key, and a map saved
+# before the H3 table was (re)built is regenerated so it picks up the layer.
+@st.cache_resource
+def get_kepler_html(map_path, config_path, hexes_mtime):
+    map_mtime = file_mtime(map_path)
+    if map_mtime is None:
+        build_kepler_map(map_path, config_path, hexes_mtime is not None)
+    elif hexes_mtime is not None and hexes_mtime > map_mtime:
+        try:
+            build_kepler_map(map_path, config_path, True)
+        except ImportError:
+            # keplergl is optional (not in requirements.txt): keep the saved map
+            st.warning("⚠️ keplergl is not installed, showing the saved map without the H3 demand layer.")
+
+    with open(map_path, "r", encoding="utf-8") as f:
+        return f.read()
 
 # --- BAR CHART (Top 20 Start Stations) ---
 st.subheader("📊 Top 20 Most Popular Start Stations")
-top_stations = (
-    df.groupby("start_station_name")
-    .size()
-    .reset_index(name="trip_count")
-    .sort_values("trip_count", ascending=False)
-    .head(20)
-)
+top_stations = load_stations(STATIONS_PATH, source_mtime(STATIONS_PATH, RAW_PARQUET_PATH, RAW_CSV_PATH)).head(20)
 fig_bar = px.bar(
     top_stations,
     x="start_station_name",
@@ -61,19 +146,17 @@ st.plotly_chart(fig_bar, use_container_width=True)
 
 # --- DUAL AXIS LINE CHART (Trips vs Temperature) ---
 st.subheader("📈 Daily Trips vs Average Temperature (2022)")
-daily_trips = df.groupby("date").size().reset_index(name="trip_count")
-daily_temp = df.groupby("date")["avgTemp"].mean().reset_index()
-daily_data = pd.merge(daily_trips, daily_temp, on="date")
+daily_data = load_daily(DAILY_PATH, source_mtime(DAILY_PATH, RAW_PARQUET_PATH, RAW_CSV_PATH))
 
 fig_dual = go.Figure()
-fig_dual.add_trace(go.Scatter(
+fig_dual.add_trace(go.Scattergl(
     x=daily_data["date"],
     y=daily_data["trip_count"],
     name="Daily Trips",
     mode="lines",
     line=dict(color="royalblue")
 ))
-fig_dual.add_trace(go.Scatter(
+fig_dual.add_trace(go.Scattergl(
     x=daily_data["date"],
     y=daily_data["avgTemp"],
     name="Average Temperature (°C)",
@@ -101,10 +184,6 @@ st.markdown(
 )
 
 try:
-    import json
-    import os
-    from keplergl import KeplerGl
-
     # Define absolute paths based on your setup
     project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     map_path = os.path.join(project_root, "citibike_aggregated_map.html")
@@ -112,30 +191,13 @@ try:
 
     # If HTML map already exists, display it directly
     if os.path.exists(map_path):
-        with open(map_path, "r", encoding="utf-8") as f:
-            map_html = f.read()
-        st.components.v1.html(map_html, height=600)
+        st.components.v1.html(get_kepler_html(map_path, config_path, file_mtime(HEXES_PATH)), height=600)
         st.success("Loaded your customized Kepler map successfully!")
 
     # Otherwise, generate a new one using your saved config.json
     else:
         st.warning("⚠️ No existing map found. Generating a new one using config.json...")
-
-        # Prepare the aggregated dataset
-        df_map = (
-            df.groupby(["start_station_name", "end_station_name", "start_lat", "start_lng", "end_lat", "end_lng"])
-            .size()
-            .reset_index(name="trip_count")
-        )
-
-        # Load the custom Kepler configuration
-        with open(config_path, "r", encoding="utf-8") as cfg:
-            custom_config = json.load(cfg)["config"]
-
-        # Create and display the map
-        map_1 = KeplerGl(height=600, data={"CitiBike 2022": df_map}, config=custom_config)
-        map_1.save_to_html(file_name=map_path)
-        st.components.v1.html(map_1._repr_html_(), height=600)
+        st.components.v1.html(get_kepler_html(map_path, config_path, file_mtime(HEXES_PATH)), height=600)
         st.success("✅ New map generated and saved using config.json!")
 
 except Exception as e:
@@ -3,6 +3,11 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import os
+from citibike_aggregates import (
+    RAW_PARQUET_PATH, DAILY_PATH, STATIONS_PATH, DAILY_COLUMNS, STATION_COLUMNS,
+    source_mtime, read_trips_parquet, aggregate_csv_in_chunks, daily_aggregate, station_aggregate
+)
 
 # --- PAGE CONFIG ---
 st.set_page_config(
@@ -23,50 +28,77 @@ page = st.sidebar.radio(
     ]
 )
 
+# ✅ Dropbox direct download link, used when the local Parquet copy is missing
+DATA_URL = "https://www.dropbox.com/scl/fi/8q9mvx7nawv6w0jyd1weg/citibike_weather_2022.csv?rlkey=1ror146lz3rofxchwwqpsxn2l&st=k4e5zsue&dl=1"
+
 # --- LOAD DATA FUNCTION ---
-@st.cache_data
-def load_data():
-    try:
-        # ✅ Dropbox direct download link
-        url = "https://www.dropbox.com/scl/fi/8q9mvx7nawv6w0jyd1weg/citibike_weather_2022.csv?rlkey=1ror146lz3rofxchwwqpsxn2l&st=k4e5zsue&dl=1"
+# Not cached: only the small aggregates built from the raw trips are kept.
+def load_data(columns):
+    # 'date' is always read so rows without a trip date can be dropped below
+    columns = ["date"] + [c for c in columns if c != "date"]
+    # ✅ Local Parquet copy (scripts/csv_to_parquet.py).
+    # Errors are raised, not turned into an empty frame, so that nothing empty
+    # gets persisted by the loaders below; the session-state block reports them.
+    df = read_trips_parquet(columns)
 
-        df = pd.read_csv(url, low_memory=False, on_bad_lines="skip")
+    # Drop rows missing essential info
+    df = df.dropna(subset=["date"])
 
-        # --- Normalize column names ---
-        df.columns = [c.strip().replace(" ", "_").lower() for c in df.columns]
+    st.success(f"✅ Data loaded successfully — {len(df):,} rows.")
+    return df
 
-        # --- Create a consistent 'date' column ---
-        if "date" in df.columns:
-            df["date"] = pd.to_datetime(df["date"], errors="coerce")
-        elif "started_at" in df.columns:
-            df["date"] = pd.to_datetime(df["started_at"], errors="coerce").dt.date
-        else:
-            df["date"] = pd.NaT
+# --- CSV DOWNLOAD FALLBACK ---
+# Parses the Dropbox CSV in chunks while it downloads and keeps only the
+# daily and station aggregates, so the full trip table is never held in
+# memory. Errors are raised, not cached, so a failed download is retried
+# on the next rerun.
+@st.cache_data(persist="disk", show_spinner="Downloading and aggregating the trips CSV…")
+def load_remote_aggregates(url):
+    daily, stations = aggregate_csv_in_chunks(url, ("daily", "stations"), on_bad_lines="skip")
+    st.success(f"✅ Data loaded successfully — {daily['trip_count'].sum():,} trips.")
+    return daily, stations
 
-        # Drop rows missing essential info
-        df = df.dropna(subset=["date"])
+# --- LOAD AGGREGATES ---
+# Built by scripts/build_aggregates.py; the raw trips are only loaded and
+# grouped when the prepared files are missing.
+# Results are persisted to disk, so a restarted app skips the raw load.
+# The cache key is (path, mtime), never a DataFrame, where mtime is that of
+# the prepared file or else of the raw Parquet it falls back to, so
+# rebuilding either gives a new entry. Aggregates of the downloaded CSV
+# (mtime None) stay persisted until `streamlit cache clear`.
+@st.cache_data(persist="disk", show_spinner="Loading daily trips…")
+def load_daily(path, mtime):
+    if os.path.exists(path):
+        return pd.read_feather(path)
+    if not os.path.exists(RAW_PARQUET_PATH):
+        return load_remote_aggregates(DATA_URL)[0]
+    return daily_aggregate(load_data(DAILY_COLUMNS))
 
-        st.success(f"✅ Data loaded successfully — {len(df):,} rows.")
-        return df
+@st.cache_data(persist="disk", show_spinner="Loading station totals…")
+def load_stations(path, mtime):
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    if not os.path.exists(RAW_PARQUET_PATH):
+        return load_remote_aggregates(DATA_URL)[1]
+    return station_aggregate(load_data(STATION_COLUMNS))
 
+# --- AGGREGATES FOR THIS SESSION ---
+# Loaded on the first render; switching pages only reads them back from session state
+if "agg" not in st.session_state:
+    try:
+        st.session_state["agg"] = {
+            "daily": load_daily(DAILY_PATH, source_mtime(DAILY_PATH, RAW_PARQUET_PATH)),
+            "stations": load_stations(STATIONS_PATH, source_mtime(STATIONS_PATH, RAW_PARQUET_PATH))
+        }
     except Exception as e:
         st.error(f"❌ Failed to load data: {e}")
-        # Return an empty DataFrame with all expected columns
-        cols = [
-            "date", "start_station_name", "start_lat", "start_lng", "avgtemp",
-            "ride_id", "rideable_type", "member_casual"
-        ]
-        return pd.DataFrame(columns=cols)
-
-# --- SAFETY NET: Load Data ---
-try:
-    df = load_data()
-except Exception as e:
-    st.error(f"Unexpected error while loading data: {e}")
-    df = pd.DataFrame(columns=["date"])
+agg = st.session_state.get("agg", {
+    "daily": pd.DataFrame(columns=["date", "trip_count", "avgTemp"]),
+    "stations": pd.DataFrame(columns=STATION_COLUMNS + ["trip_count"])
+})
 
 # --- PAGE 1: INTRODUCTION ---
-if page == "Introduction":
+def render_introduction():
     st.title("CitiBike NYC 2022 Dashboard")
     st.markdown("""
     This dashboard explores **New York City’s CitiBike system (2022)** —  
@@ -82,30 +114,24 @@ if page == "Introduction":
     - Recommendations
     """)
 
-    if df.empty:
+    daily = agg["daily"]
+    if daily.empty:
         st.warning("⚠️ No data loaded yet. Please check your dataset link.")
     else:
         st.subheader("Preview of Loaded Data")
-        st.dataframe(df.head())
+        st.dataframe(daily.head())
+
 
 # --- PAGE 2: WEATHER AND BIKE USAGE ---
-elif page == "Weather and Bike Usage":
+def render_weather():
     st.header("Weather and Bike Usage")
 
-    if df.empty:
+    daily_data = agg["daily"]
+    if daily_data.empty:
         st.warning("⚠️ No data available for analysis.")
     else:
-        daily_trips = df.groupby("date").size().reset_index(name="trip_count")
-
-        if "avgtemp" in df.columns:
-            daily_temp = df.groupby("date")["avgtemp"].mean().reset_index()
-            daily_data = pd.merge(daily_trips, daily_temp, on="date", how="left")
-        else:
-            daily_data = daily_trips.copy()
-            daily_data["avgtemp"] = None
-
         fig_dual = go.Figure()
-        fig_dual.add_trace(go.Scatter(
+        fig_dual.add_trace(go.Scattergl(
             x=daily_data["date"],
             y=daily_data["trip_count"],
             name="Daily Trips",
@@ -113,10 +139,10 @@ elif page == "Weather and Bike Usage":
             line=dict(color="royalblue")
         ))
 
-        if daily_data["avgtemp"].notna().any():
-            fig_dual.add_trace(go.Scatter(
+        if daily_data["avgTemp"].notna().any():
+            fig_dual.add_trace(go.Scattergl(
                 x=daily_data["date"],
-                y=daily_data["avgtemp"],
+                y=daily_data["avgTemp"],
                 name="Average Temperature (°C)",
                 mode="lines",
                 line=dict(color="tomato"),
@@ -136,25 +162,20 @@ elif page == "Weather and Bike Usage":
         st.plotly_chart(fig_dual, use_container_width=True)
         st.markdown("**Observation:** Ridership rises with temperature and declines in colder months.")
 
+
 # --- PAGE 3: MOST POPULAR STATIONS ---
-elif page == "Most Popular Stations":
+def render_stations():
     st.header("Most Popular Start Stations")
 
-    if df.empty or "start_station_name" not in df.columns:
+    top_stations = agg["stations"].head(20)
+    if top_stations.empty:
         st.warning("⚠️ Missing column 'start_station_name' in dataset.")
     else:
-        df["value"] = 1
-        top_stations = (
-            df.groupby("start_station_name", as_index=False)
-            .agg({"value": "sum"})
-            .nlargest(20, "value")
-        )
-
         fig_bar = px.bar(
             top_stations,
             x="start_station_name",
-            y="value",
-            color="value",
+            y="trip_count",
+            color="trip_count",
             color_continuous_scale="Blues",
             title="Top 20 Start Stations (2022)"
         )
@@ -168,18 +189,21 @@ elif page == "Most Popular Stations":
         st.plotly_chart(fig_bar, use_container_width=True)
         st.markdown("**Insight:** Busiest stations cluster in Manhattan — strong commuter and tourist flow.")
 
+
 # --- PAGE 4: INTERACTIVE MAP ---
-elif page == "Interactive Map":
+def render_map():
     st.header("Interactive Map – CitiBike Stations and Routes")
     st.markdown("Each point represents a start station sized by total trip count.")
 
-    if df.empty or not {"start_station_name", "start_lat", "start_lng"}.issubset(df.columns):
+    df_map = agg["stations"]
+    if df_map.empty:
         st.warning("⚠️ Missing required columns for map visualization.")
     else:
+        # Only the plotted columns go to the browser; 5 decimals (~1 m) keep the JSON short
         df_map = (
-            df.groupby(["start_station_name", "start_lat", "start_lng"], as_index=False)
-            .size()
-            .rename(columns={"size": "trip_count"})
+            df_map[["start_station_name", "start_lat", "start_lng", "trip_count"]]
+            .astype({"start_lat": "float64", "start_lng": "float64"})
+            .round({"start_lat": 5, "start_lng": 5})
         )
 
         fig_map = px.scatter_mapbox(
@@ -200,8 +224,9 @@ elif page == "Interactive Map":
         )
         st.plotly_chart(fig_map, use_container_width=True)
 
+
 # --- PAGE 5: RECOMMENDATIONS ---
-elif page == "Recommendations":
+def render_recommendations():
     st.header("Recommendations and Next Steps")
     st.markdown("""
     ### Key Takeaways
@@ -216,6 +241,18 @@ elif page == "Recommendations":
     **3. Stock Balance** — Predictive rebalancing & user incentives keep busy stations filled.
     """)
 
+
+# --- RENDER THE SELECTED PAGE ---
+# Only the selected page's function runs on each rerun
+PAGES = {
+    "Introduction": render_introduction,
+    "Weather and Bike Usage": render_weather,
+    "Most Popular Stations": render_stations,
+    "Interactive Map": render_map,
+    "Recommendations": render_recommendations
+}
+PAGES[page]()
+
 # --- FOOTER ---
 st.markdown("---")
 st.caption("Data Source: CitiBike NYC (2022) | NOAA Weather Data | Dashboard by Brahim Boukaskas")
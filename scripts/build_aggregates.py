@@ -0,0 +1,96 @@
+# build_aggregates.py
+# Reads the raw trips Parquet once (see csv_to_parquet.py), or streams the
+# merged CSV in chunks if there is no Parquet copy, and writes the small
+# daily / station / route tables the dashboards load at runtime.
+# Uses Polars' parallel lazy engine when it is installed, pandas otherwise.
+# With the h3 package installed it also writes an H3 demand table (hexes.parquet).
+import os
+import sys
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(project_root, "notebooks"))
+
+from citibike_aggregates import (
+    RAW_PARQUET_PATH, RAW_CSV_PATH, PREPARED_DIR, DAILY_PATH, STATIONS_PATH, ROUTES_PATH, HEXES_PATH,
+    DAILY_COLUMNS, STATION_COLUMNS, ROUTE_COLUMNS, ROUTE_KEYS, POINT_COLUMNS,
+    daily_aggregate, station_aggregate, route_aggregate, point_aggregate, hex_aggregate,
+    read_trips_parquet, aggregate_csv_in_chunks, h3
+)
+
+
+def aggregate_with_polars(path):
+    """Same tables as the pandas *_aggregate functions, from one lazy Parquet scan."""
+    lf = pl.scan_parquet(path)
+    trip_count = pl.len().cast(pl.Int32).alias("trip_count")
+
+    # Polars keeps a group for null keys, pandas' groupby drops those rows;
+    # and first() would return a null where pandas' "first" skips them
+    daily = (
+        lf.filter(pl.col("date").is_not_null())
+        .group_by("date")
+        .agg(trip_count, pl.col("avgTemp").mean().cast(pl.Float32))
+        .sort("date")
+    )
+    stations = (
+        lf.filter(pl.col("start_station_name").is_not_null())
+        .group_by("start_station_name")
+        .agg(pl.col("start_lat").drop_nulls().first(), pl.col("start_lng").drop_nulls().first(), trip_count)
+        .with_columns(pl.col("start_station_name").cast(pl.String))
+        .sort("trip_count", descending=True)
+    )
+    routes = (
+        lf.filter(pl.all_horizontal([pl.col(k).is_not_null() for k in ROUTE_KEYS]))
+        .group_by(ROUTE_KEYS)
+        .agg([pl.col(c).drop_nulls().first() for c in ROUTE_COLUMNS[2:]] + [trip_count])
+    )
+    points = (
+        lf.filter(pl.all_horizontal([pl.col(c).is_not_null() for c in POINT_COLUMNS]))
+        .group_by(POINT_COLUMNS)
+        .agg(trip_count)
+    )
+
+    # All four queries share a single scan of the Parquet file
+    return [table.to_pandas() for table in pl.collect_all([daily, stations, routes, points])]
+
+
+def aggregate_with_pandas(path):
+    columns = list(dict.fromkeys(DAILY_COLUMNS + STATION_COLUMNS + ROUTE_COLUMNS))
+    df = read_trips_parquet(columns, path)
+    return [daily_aggregate(df), station_aggregate(df), route_aggregate(df), point_aggregate(df)]
+
+
+if __name__ == "__main__":
+    if os.path.exists(RAW_PARQUET_PATH):
+        aggregate = aggregate_with_polars if pl is not None else aggregate_with_pandas
+        print(f"Aggregating {RAW_PARQUET_PATH} with {'polars' if pl is not None else 'pandas'}")
+        daily, stations, routes, points = aggregate(RAW_PARQUET_PATH)
+    else:
+        # No Parquet copy yet: stream the CSV instead of loading every trip at once
+        print(f"Aggregating {RAW_CSV_PATH} in chunks")
+        daily, stations, routes, points = aggregate_csv_in_chunks(RAW_CSV_PATH)
+
+    os.makedirs(PREPARED_DIR, exist_ok=True)
+
+    # The daily table is tiny: uncompressed Feather loads without any decoding
+    daily.to_feather(DAILY_PATH, compression="uncompressed")
+    print(f"Saved daily: {len(daily):,} rows -> {DAILY_PATH}")
+
+    for name, path, table in [
+        ("stations", STATIONS_PATH, stations),
+        ("routes", ROUTES_PATH, routes)
+    ]:
+        table.to_parquet(path, engine="pyarrow", index=False)
+        print(f"Saved {name}: {len(table):,} rows -> {path}")
+
+    # Demand heatmap cells for the Kepler map (optional, needs the h3 package)
+    if h3 is not None:
+        hexes = hex_aggregate(points)
+        hexes.to_parquet(HEXES_PATH, engine="pyarrow", index=False)
+        print(f"Saved hexes: {len(hexes):,} rows -> {HEXES_PATH}")
+    else:
+        print("h3 is not installed, skipping the H3 demand table")
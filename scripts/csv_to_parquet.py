@@ -0,0 +1,27 @@
+# csv_to_parquet.py
+# One-shot conversion of the merged CitiBike + weather CSV (written by
+# notebooks/2.2_citibike_weather_merge.ipynb) into a compressed Parquet file.
+# The dashboards read the Parquet file and only pull the columns they plot.
+import os
+import sys
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(project_root, "notebooks"))
+
+from citibike_aggregates import read_trips_csv
+
+csv_path = os.path.join(project_root, "temp_storage", "data_raw", "citibike_weather_2022.csv")
+parquet_path = os.path.join(project_root, "temp_storage", "data_raw", "citibike_weather_2022.parquet")
+
+if __name__ == "__main__":
+    # Station names are read as categories, so Parquet stores them dictionary-encoded
+    df = read_trips_csv(csv_path, low_memory=False)
+
+    df.to_parquet(
+        parquet_path,
+        engine="pyarrow",
+        compression="zstd",
+        row_group_size=200_000,
+        index=False
+    )
+    print(f"Saved {len(df):,} rows to {parquet_path}")